@@ -1,10 +1,17 @@
 # app.py
 import io
 import os
-import uuid
+import logging
+import functools
+import time
+import secrets
+import threading
+import multiprocessing
 import datetime as dt
-from urllib.parse import urlencode
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import unquote, urlencode
 
+import numpy as np
 import pandas as pd
 from flask import (
     Flask,
@@ -15,15 +22,17 @@ from flask import (
     flash,
     abort,
     send_file,
+    jsonify,
 )
 
 from config import Config
 from services.storage import get_storage
-from services.pdf_service import register_fonts, build_styles, build_pdf
+from services.pdf_service import register_fonts, build_styles, build_pdf_pair, build_pdf_pair_bytes
 from utils.files import safe_filename
 
 cfg = Config()
 cfg.log_env()
+log = logging.getLogger(__name__)
 
 # ディレクトリ作成（ローカル開発で使用）
 os.makedirs(cfg.UPLOAD_FOLDER, exist_ok=True)
@@ -38,6 +47,7 @@ app = Flask(__name__, template_folder=cfg.TEMPLATE_DIR, static_folder="static")
 app.secret_key = cfg.SECRET_KEY
 app.config["UPLOAD_FOLDER"] = cfg.UPLOAD_FOLDER
 app.config["MAX_CONTENT_LENGTH"] = cfg.MAX_CONTENT_LENGTH
+app.config["USE_X_SENDFILE"] = cfg.USE_X_SENDFILE
 
 # ストレージ実体（R2 or Local）
 storage = get_storage(cfg)
@@ -46,16 +56,195 @@ storage = get_storage(cfg)
 FONT_NAME = register_fonts(cfg.FONTS_DIR)
 styles = build_styles(FONT_NAME)
 
+# 問題/解答 PDF の生成と R2 へのアップロードを並行させるためのスレッドプール
+PDF_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="pdf")
+
+# 組版用の子プロセスプール（cfg.PDF_PROCESSES > 0 のときだけ、pdf_process_pool() で作る）
+_PDF_PROCESS_POOL: ProcessPoolExecutor | None = None
+_PDF_PROCESS_POOL_LOCK = threading.Lock()
+
+# 出題の抽選に使う乱数生成器（プロセスごとに1つ。rng() から取る）
+_RNG: tuple[int, np.random.Generator] | None = None
+
+
+# 読み込む Excel の列（これ以外の列はパースしない）
+XLSX_COLUMNS = frozenset({"number", "word", "meaning", "section"})
+XLSX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# 一覧取得（R2 の LIST / ローカルの走査）の結果を短時間だけ使い回す
+# prefix → (取得時刻, keys)。アップロード成功時にクリアする。
+_LIST_CACHE: dict[str, tuple[float, list[str]]] = {}
+_LIST_CACHE_LOCK = threading.Lock()
+
 
 # ========= ユーティリティ =========
-def list_xlsx() -> list[str]:
+def list_xlsx(*, refresh: bool = False) -> list[str]:
     """
     アップロード済み .xlsx を “uploads/.../*.xlsx” のフルキーで返す。
+    refresh=True ならキャッシュを使わずに取り直す。
+    """
+    prefix = "uploads/"
+    now = time.monotonic()
+    if not refresh:
+        with _LIST_CACHE_LOCK:
+            hit = _LIST_CACHE.get(prefix)
+        if hit and now - hit[0] < cfg.LIST_CACHE_TTL:
+            return list(hit[1])
+
+    keys = storage.list_xlsx(prefix=prefix) or []  # .xlsx の絞り込みはストレージ側で済んでいる
+    log.debug("[FILES] count=%d sample=%s", len(keys), keys[:5])
+    with _LIST_CACHE_LOCK:
+        _LIST_CACHE[prefix] = (now, keys)
+    return list(keys)
+
+
+def invalidate_list_cache() -> None:
+    with _LIST_CACHE_LOCK:
+        _LIST_CACHE.clear()
+
+
+def load_xlsx_df(key: str) -> pd.DataFrame:
+    """
+    ストレージ上の .xlsx を取得して DataFrame にする（取得＋パースを1か所に集約）。
+    版（ETag / mtime）が変わらない間はパース結果を使い回す。
+    呼び出し側で列を足したり書き換えたりするので、キャッシュのコピーを返す。
+    """
+    return _read_xlsx_df(key, storage.head(key)).copy()
+
+
+@functools.lru_cache(maxsize=16)
+def _read_xlsx_df(key: str, version: str) -> pd.DataFrame:
+    data = storage.open_xlsx_as_bytes(key)
+    # calamine（Rust 実装）で読み、使う列だけ残す（無い列は後段で判定）
+    df = pd.read_excel(
+        io.BytesIO(data),
+        engine="calamine",
+        usecols=lambda c: c in XLSX_COLUMNS,
+    )
+    if "section" in df.columns:
+        # 種類の少ない列なので category で持ち、絞り込みを整数コードの比較にする
+        df["section"] = df["section"].astype("category")
+    return df
+
+
+def load_xlsx_sections(key: str) -> tuple[str, ...] | None:
+    """
+    section 列の値一覧（文字列化・重複なし・ソート済み）。列が無ければ None。
+    /make の GET で毎回ユニーク化・ソートしないよう、版ごとに結果を持っておく。
+    """
+    return _xlsx_sections(key, storage.head(key))
+
+
+@functools.lru_cache(maxsize=16)
+def _xlsx_sections(key: str, version: str) -> tuple[str, ...] | None:
+    df = _read_xlsx_df(key, version)
+    if "section" not in df.columns:
+        return None
+    # category の categories は出現した値（欠損を除く）だけ
+    return tuple(sorted({str(s) for s in df["section"].cat.categories}))
+
+
+@functools.lru_cache(maxsize=256)
+def _presign_for_window(key: str, window: int) -> str | None:
+    # 生成 PDF は中身が変わらないので、R2 からの応答にも長期キャッシュを付けさせる
+    cache_control = None
+    if key.startswith("generated/") and cfg.GENERATED_PDF_MAX_AGE:
+        cache_control = f"public, max-age={cfg.GENERATED_PDF_MAX_AGE}, immutable"
+    return storage.presign_get(key, cfg.PRESIGN_EXPIRES, cache_control=cache_control)
+
+
+def presign_get_cached(key: str) -> str | None:
+    """
+    署名付きURLを有効期限の 1/4 の間だけ使い回す。
+    返すURLは少なくとも有効期限の 3/4 は有効なまま。
+    """
+    window = int(time.time()) // max(1, cfg.PRESIGN_EXPIRES // 4)
+    return _presign_for_window(key, window)
+
+
+def pdf_process_pool() -> ProcessPoolExecutor | None:
+    """
+    PDF の組版を任せる子プロセスプールを返す（cfg.PDF_PROCESSES が 0 なら None）。
+    --preload の親で作るとワーカー間でキューを共有してしまうので、各ワーカーで最初に使うときに作る。
+    スレッドを抱えたプロセスからの fork を避けるため spawn で起動する。
+    """
+    global _PDF_PROCESS_POOL
+    if cfg.PDF_PROCESSES <= 0:
+        return None
+    with _PDF_PROCESS_POOL_LOCK:
+        if _PDF_PROCESS_POOL is None:
+            _PDF_PROCESS_POOL = ProcessPoolExecutor(
+                max_workers=cfg.PDF_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _PDF_PROCESS_POOL
+
+
+def rng() -> np.random.Generator:
+    """
+    出題の抽選に使う乱数生成器を返す。
+    --preload の親で作ると fork したワーカーがすべて同じ状態を引き継ぎ、同じ出題になるので、
+    プロセス（pid）ごとに最初に使うときに作る。
+    """
+    global _RNG
+    pid = os.getpid()
+    if _RNG is None or _RNG[0] != pid:
+        _RNG = (pid, np.random.default_rng())
+    return _RNG[1]
+
+
+def build_and_store_pair(
+    sample: pd.DataFrame,
+    *,
+    question_col: str,
+    answer_col: str,
+    title_q: str,
+    title_a: str,
+    q_name: str,
+    a_name: str,
+) -> tuple[str, str]:
     """
-    keys = storage.list_xlsx(prefix="uploads/") or []
-    keys = [k for k in keys if k.lower().endswith(".xlsx")]
-    print(f"[FILES] count={len(keys)} sample={keys[:5]}", flush=True)
-    return keys
+    1部ぶんの問題/解答 PDF を生成して保存し、/download に渡す (問題, 解答) の識別子を返す。
+    R2 なら 'generated/...' のキー、ローカルなら PDF_LOCAL_DIR 内のファイル名。
+    行の取り出しと高さ計測は build_pdf_pair の中で1回だけ行う。
+    """
+    pair_kwargs = dict(question_col=question_col, answer_col=answer_col, title_q=title_q, title_a=title_a)
+    pool = pdf_process_pool()
+    if pool is not None:
+        # 組版は子プロセスで行い（GIL を取り合わない）、保存はこのスレッドで行う
+        q_bytes, a_bytes = pool.submit(build_pdf_pair_bytes, sample, cfg.FONTS_DIR, **pair_kwargs).result()
+        return store_pdf(io.BytesIO(q_bytes), q_name), store_pdf(io.BytesIO(a_bytes), a_name)
+    if cfg.USE_R2:
+        q_buf, a_buf = build_pdf_pair(sample, styles, **pair_kwargs)
+        return store_pdf(q_buf, q_name), store_pdf(a_buf, a_name)
+
+    # ローカルは保存先のファイルへ直接書き出し、BytesIO に溜めてから書き写さない
+    paths = [os.path.join(PDF_LOCAL_DIR, q_name), os.path.join(PDF_LOCAL_DIR, a_name)]
+    try:
+        with open(paths[0], "wb") as q_out, open(paths[1], "wb") as a_out:
+            build_pdf_pair(sample, styles, q_out=q_out, a_out=a_out, **pair_kwargs)
+    except Exception:
+        # 書きかけのファイルを残さない
+        for p in paths:
+            if os.path.exists(p):
+                os.remove(p)
+        raise
+    return q_name, a_name
+
+
+def store_pdf(buf: io.BytesIO, pdf_name: str) -> str:
+    """
+    生成済み PDF を保存し、/download に渡す識別子を返す。
+    R2 なら 'generated/...' のキー、ローカルなら PDF_LOCAL_DIR 内のファイル名。
+    BytesIO のまま扱い、bytes へのコピーを作らない。
+    """
+    if cfg.USE_R2:
+        key = f"generated/{pdf_name}"
+        storage.upload(buf, key, "application/pdf")
+        return key
+    with open(os.path.join(PDF_LOCAL_DIR, pdf_name), "wb") as f:
+        f.write(buf.getbuffer())
+    return pdf_name
 
 
 def parse_optional_positive_int(
@@ -94,17 +283,15 @@ def upload():
         if "file" in request.files and request.files["file"] and request.files["file"].filename:
             file = request.files["file"]
             filename = safe_filename(file.filename)
-            _, ext = os.path.splitext(filename)
-            if ext.lower() not in cfg.ALLOWED_UPLOAD_EXTENSIONS:
+            if not filename.lower().endswith(cfg.ALLOWED_UPLOAD_SUFFIXES):
                 flash(".xlsx のみアップロード可です。")
                 return redirect(url_for("upload"))
             try:
                 key = f"uploads/{filename}"
-                storage.upload(
-                    file,
-                    key,
-                    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                )
+                # Werkzeug が一時ファイルに逃がした本体をそのまま渡す（メモリに読み込まない）
+                file.stream.seek(0)
+                storage.upload(file.stream, key, XLSX_CONTENT_TYPE)
+                invalidate_list_cache()
                 flash(f"アップロードが完了しました: {filename}")
             except Exception as e:
                 flash(f"アップロードに失敗しました: {e}")
@@ -114,7 +301,76 @@ def upload():
         return redirect(url_for("upload"))
 
     files = list_xlsx()
-    return render_template("upload.html", files=files)
+    return render_template(
+        "upload.html",
+        files=files,
+        direct_upload=cfg.USE_R2,
+        max_bytes=cfg.MAX_CONTENT_LENGTH,
+    )
+
+
+@app.route("/upload/raw", methods=["PUT"])
+def upload_raw():
+    """
+    本体をそのままボディで受け取るアップロード（ファイル名は X-Filename ヘッダ、URL エンコード）。
+    multipart を解析せず、request.stream をチャンクのままストレージへ流す。
+    MAX_CONTENT_LENGTH を超えるボディは Flask が 413 にする。
+    """
+    filename = safe_filename(unquote(request.headers.get("X-Filename", "")))
+    if not filename.lower().endswith(cfg.ALLOWED_UPLOAD_SUFFIXES):
+        return jsonify(error=".xlsx のみアップロード可です。"), 400
+    if request.content_length is None:
+        return jsonify(error="Content-Length が必要です。"), 411
+    # 上限超過はここで 413（書き込みを始める前に判定される）
+    stream = request.stream
+    try:
+        storage.upload(stream, f"uploads/{filename}", XLSX_CONTENT_TYPE)
+    except Exception as e:
+        log.warning("raw upload failed: %s (%s)", filename, e)
+        return jsonify(error=f"アップロードに失敗しました: {e}"), 500
+    invalidate_list_cache()
+    flash(f"アップロードが完了しました: {filename}")
+    return jsonify(ok=True)
+
+
+@app.route("/upload/presign")
+def upload_presign():
+    """
+    R2 のとき、ブラウザから直接 PUT するための署名 URL を返す。
+    ファイル本体は Flask を通らない。ローカルでは 404（フォーム送信に戻る）。
+    サイズ（size）を受け取って MAX_CONTENT_LENGTH を超えるものは断り、
+    署名にも Content-Length を含めて、申告と違うサイズは R2 側で拒否させる。
+    """
+    filename = safe_filename(request.args.get("name", ""))
+    if not filename.lower().endswith(cfg.ALLOWED_UPLOAD_SUFFIXES):
+        return jsonify(error=".xlsx のみアップロード可です。"), 400
+    size = request.args.get("size", type=int)
+    if size is None or size <= 0:
+        return jsonify(error="ファイルサイズが不正です。"), 400
+    if size > cfg.MAX_CONTENT_LENGTH:
+        return jsonify(error="ファイルサイズが大きすぎます。"), 413
+    key = f"uploads/{filename}"
+    url = storage.presign_put(key, XLSX_CONTENT_TYPE, size)
+    if not url:
+        abort(404)
+    return jsonify(url=url, key=key, content_type=XLSX_CONTENT_TYPE)
+
+
+@app.route("/upload/complete", methods=["POST"])
+def upload_complete():
+    """ブラウザからの直接 PUT が終わった後に呼ばれ、実在を確認して一覧を更新する。"""
+    key = request.form.get("key", "")
+    filename = key.removeprefix("uploads/")
+    if key != f"uploads/{safe_filename(filename)}" or not filename.lower().endswith(cfg.ALLOWED_UPLOAD_SUFFIXES):
+        return jsonify(error="不正なキーです。"), 400
+    try:
+        storage.head(key)
+    except Exception as e:
+        log.warning("direct upload not found: %s (%s)", key, e)
+        return jsonify(error="アップロードされたファイルが見つかりません。"), 404
+    invalidate_list_cache()
+    flash(f"アップロードが完了しました: {filename}")
+    return jsonify(ok=True)
 
 
 @app.route("/make", methods=["GET", "POST"])
@@ -148,15 +404,16 @@ def make():
             flash(str(e))
             return redirect(url_for("make", file=filename))
 
-        # ファイルチェック
+        # ファイルチェック（別ワーカーでのアップロード直後はキャッシュが古いので取り直す）
+        if filename and filename not in files:
+            files = list_xlsx(refresh=True)
         if not filename or filename not in files:
             flash("不正なファイル名です。")
             return redirect(url_for("make"))
 
         # Excel 読み込み
         try:
-            data = storage.open_xlsx_as_bytes(filename)
-            df = pd.read_excel(io.BytesIO(data), engine="openpyxl")
+            df = load_xlsx_df(filename)
 
             required = {"word", "meaning"}
             missing = required - set(df.columns)
@@ -178,8 +435,11 @@ def make():
                     flash("セクションを1つ以上選択してください。")
                     return redirect(url_for("make", file=filename))
 
-                df["__section_str__"] = df["section"].astype(str)
-                df = df[df["__section_str__"].isin(sections_selected)]
+                # 文字列化と isin は categories（セクション数ぶん）だけで行い、
+                # 各行はコードで引く。欠損（コード -1）は末尾の False に当たる
+                sec = df["section"].cat
+                wanted = np.append(sec.categories.astype(str).isin(sections_selected), False)
+                df = df[wanted[sec.codes.to_numpy()]]
                 if df.empty:
                     flash("選択したセクションに該当する問題がありません。")
                     return redirect(url_for("make", file=filename))
@@ -199,12 +459,12 @@ def make():
                     flash("番号範囲で出題するには number 列が必要です。")
                     return redirect(url_for("make", file=filename))
 
-                num_series = pd.to_numeric(df["number"], errors="coerce")
-                df = df.loc[num_series.notna()].copy()
-                if df.empty:
+                # 数値化した number を NumPy 配列で持つ（欠損は NaN）。
+                # 範囲判定も表示も整数部で行う（3.7 は No.3 として扱う）ので、先に切り捨てておく
+                nums = np.trunc(pd.to_numeric(df["number"], errors="coerce").to_numpy(dtype="float64"))
+                if np.isnan(nums).all():
                     flash("number 列に有効な数値がありません。")
                     return redirect(url_for("make", file=filename))
-                df["number"] = num_series.loc[df.index].astype(int)
 
                 start_num = request.form.get("start_num", "")
                 end_num = request.form.get("end_num", "")
@@ -218,10 +478,13 @@ def make():
                     flash("開始番号は終了番号以下にしてください。")
                     return redirect(url_for("make", file=filename))
 
-                df = df[(df["number"] >= start_num) & (df["number"] <= end_num)]
-                if df.empty:
+                # 範囲内の行位置を1回の比較で求める（NaN はどちらの比較も False）
+                in_range = np.flatnonzero((nums >= start_num) & (nums <= end_num))
+                if in_range.size == 0:
                     flash("指定範囲に該当する問題がありません。")
                     return redirect(url_for("make", file=filename))
+                # 該当行だけを1回で取り出し、number を整数にする
+                df = df.take(in_range).assign(number=nums[in_range].astype("int64"))
 
                 title_range_part = f"No.{start_num}–{end_num}"
 
@@ -251,18 +514,21 @@ def make():
         title_a_base = f"{title_base}：解答（{title_common}）"
 
         stamp = dt.datetime.now().strftime("%Y%m%d-%H%M%S")
+        q_prefix = f"questions_{title_base}_{stamp}"
+        a_prefix = f"answers_{title_base}_{stamp}"
 
         # ✅ download へ q/a を複数渡す（順番は q,a,q,a,...）
-        download_args: list[tuple[str, str]] = []
+        pending: list[Future] = []
 
         try:
             for set_idx in range(1, num_sets + 1):
-                sample = df.sample(n=n).reset_index(drop=True)
+                idx = rng().choice(len(df), size=n, replace=False)
+                sample = df.take(idx).reset_index(drop=True)
 
-                uid = uuid.uuid4().hex[:8]
+                uid = secrets.token_hex(4)
                 suffix = f"_v{set_idx}" if num_sets > 1 else ""
-                q_name = f"questions_{title_base}_{stamp}{suffix}_{uid}.pdf"
-                a_name = f"answers_{title_base}_{stamp}{suffix}_{uid}.pdf"
+                q_name = f"{q_prefix}{suffix}_{uid}.pdf"
+                a_name = f"{a_prefix}{suffix}_{uid}.pdf"
 
                 if num_sets > 1:
                     title_q = f"{title_q_base} / 第{set_idx}部"
@@ -271,40 +537,27 @@ def make():
                     title_q = title_q_base
                     title_a = title_a_base
 
-                q_pdf = build_pdf(
+                # 1部ごとにプールへ投げ、部をまたいで生成と保存を並行させる
+                pending.append(PDF_EXECUTOR.submit(
+                    build_and_store_pair,
                     sample,
-                    styles,
-                    with_answers=False,
                     question_col=question_col,
                     answer_col=answer_col,
-                    title=title_q,
-                ).read()
-
-                a_pdf = build_pdf(
-                    sample,
-                    styles,
-                    with_answers=True,
-                    question_col=question_col,
-                    answer_col=answer_col,
-                    title=title_a,
-                ).read()
-
-                if cfg.USE_R2:
-                    q_key = f"generated/{q_name}"
-                    a_key = f"generated/{a_name}"
-                    storage.upload(q_pdf, q_key, "application/pdf")
-                    storage.upload(a_pdf, a_key, "application/pdf")
-                    download_args.append(("q", q_key))
-                    download_args.append(("a", a_key))
-                else:
-                    q_path = os.path.join(PDF_LOCAL_DIR, q_name)
-                    a_path = os.path.join(PDF_LOCAL_DIR, a_name)
-                    with open(q_path, "wb") as f:
-                        f.write(q_pdf)
-                    with open(a_path, "wb") as f:
-                        f.write(a_pdf)
-                    download_args.append(("q", q_name))
-                    download_args.append(("a", a_name))
+                    title_q=title_q,
+                    title_a=title_a,
+                    q_name=q_name,
+                    a_name=a_name,
+                ))
+
+            # 投入順（第1部の q, a, 第2部の q, a, ...）で結果を集める
+            q_ids: list[str] = []
+            a_ids: list[str] = []
+            download_args: list[tuple[str, str]] = []
+            for fut in pending:
+                q_id, a_id = fut.result()
+                q_ids.append(q_id)
+                a_ids.append(a_id)
+                download_args += [("q", q_id), ("a", a_id)]
 
             if num_sets == 1:
                 flash("問題と解答PDFを作成しました！")
@@ -312,7 +565,10 @@ def make():
                 flash(f"問題と解答PDFを {num_sets} 部作成しました！")
 
             # ✅ ここが重要：同名キーを潰さず、複数 q/a をクエリに積む
-            return redirect(url_for("download") + "?" + urlencode(download_args, doseq=True))
+            download_url = url_for("download") + "?" + urlencode(download_args, doseq=True)
+            # /download へのリダイレクトを挟まず、この応答でダウンロード画面を返す。
+            # アドレスバーは download_url に差し替えるので、再読み込みしても再生成されない
+            return render_download(q_ids, a_ids, canonical_url=download_url)
 
         except Exception as e:
             flash(f"PDFの作成に失敗しました: {e}")
@@ -325,11 +581,10 @@ def make():
 
     if selected_file in files:
         try:
-            data = storage.open_xlsx_as_bytes(selected_file)
-            df_preview = pd.read_excel(io.BytesIO(data), engine="openpyxl")
-            if "section" in df_preview.columns:
+            cached_sections = load_xlsx_sections(selected_file)
+            if cached_sections is not None:
                 has_section = True
-                sections = sorted({str(s) for s in df_preview["section"].dropna().unique()})
+                sections = list(cached_sections)
         except Exception as e:
             flash(f"Excelの読み込みに失敗しました: {e}")
 
@@ -346,41 +601,60 @@ def make():
 def download():
     qs = request.args.getlist("q")
     ans = request.args.getlist("a")
-    print("[/download] qs:", qs, "as:", ans, "USE_R2:", cfg.USE_R2, flush=True)
+    log.debug("[/download] qs=%s as=%s USE_R2=%s", qs, ans, cfg.USE_R2)
+    return render_download(qs, ans)
 
+
+def render_download(qs: list[str], ans: list[str], *, canonical_url: str | None = None):
+    """
+    ダウンロード画面を描く（/download と /make の POST から共用）。
+    canonical_url を渡すと、ブラウザのアドレスをその URL に差し替える。
+    """
     if cfg.USE_R2:
         items = []
         try:
             for i, (q, a) in enumerate(zip(qs, ans), start=1):
                 q_url = a_url = None
                 if q and (q.startswith("generated/") or q.startswith("uploads/")):
-                    q_url = storage.presign_get(q, cfg.PRESIGN_EXPIRES)
+                    q_url = presign_get_cached(q)
                 if a and (a.startswith("generated/") or a.startswith("uploads/")):
-                    a_url = storage.presign_get(a, cfg.PRESIGN_EXPIRES)
+                    a_url = presign_get_cached(a)
                 items.append({"idx": i, "q_url": q_url, "a_url": a_url, "q": q, "a": a})
-            return render_template("download.html", items=items, use_r2=True)
+            return render_template("download.html", items=items, use_r2=True, canonical_url=canonical_url)
         except Exception as e:
             app.logger.exception(f"presign_get failed: {e}")
             flash("ダウンロード用URLの生成に失敗しました。時間をおいて再試行してください。")
-            return render_template("download.html", items=[], use_r2=True)
+            # /make の POST からでもアドレスは /download に差し替え、再読み込みで作り直さず署名だけやり直させる
+            return render_template("download.html", items=[], use_r2=True, canonical_url=canonical_url)
 
     # ローカル運用
     items = []
     for i, (q, a) in enumerate(zip(qs, ans), start=1):
         items.append({"idx": i, "q": q, "a": a})
-    return render_template("download.html", items=items, use_r2=False)
+    return render_template("download.html", items=items, use_r2=False, canonical_url=canonical_url)
 
 
 @app.route("/download_file/<filename>")
 def download_file(filename):
     filename = safe_filename(filename)
-    _, ext = os.path.splitext(filename)
-    if ext.lower() not in cfg.ALLOWED_DOWNLOAD_EXTENSIONS:
+    lower_name = filename.lower()
+    if not lower_name.endswith(cfg.ALLOWED_DOWNLOAD_SUFFIXES):
         flash("許可されていないファイル形式です。")
         return redirect(url_for("download"))
 
+    is_pdf = lower_name.endswith(".pdf")
+
+    # R2 運用ではアプリを経由させず、署名URLへ飛ばしてブラウザに直接取らせる
+    if cfg.USE_R2:
+        key = f"generated/{filename}" if is_pdf else f"uploads/{filename}"
+        try:
+            return redirect(presign_get_cached(key))
+        except Exception as e:
+            app.logger.exception(f"presign_get failed for {key}: {e}")
+            abort(500)
+
     # 拡張子ごとに探すディレクトリを分ける
-    if ext.lower() == ".pdf":
+    if is_pdf:
         base_dir = PDF_LOCAL_DIR
     else:
         base_dir = cfg.UPLOAD_FOLDER
@@ -390,14 +664,23 @@ def download_file(filename):
         flash("指定されたファイルが存在しません。")
         return redirect(url_for("download"))
 
+    # 生成 PDF は同名で上書きされないので長期キャッシュさせる。
+    # .xlsx は同名で再アップロードされうるので毎回 ETag で再検証させる。
+    max_age = cfg.GENERATED_PDF_MAX_AGE if is_pdf else 0
+
     try:
-        return send_file(
+        resp = send_file(
             full_path,
             as_attachment=True,
             download_name=filename,
             conditional=True,
-            max_age=0,
+            etag=True,
+            max_age=max_age,
         )
+        if is_pdf and max_age:
+            # 期限内は再検証（304 のやり取り）も要らないと伝える
+            resp.cache_control.immutable = True
+        return resp
     except Exception as e:
         app.logger.exception(f"send_file failed for {filename}: {e}")
         abort(500)
@@ -1,5 +1,6 @@
 # config.py
 import os
+import logging
 
 def mask(s, keep=4):
     return s[:keep] + "..." if s else "(unset)"
@@ -16,12 +17,17 @@ class Config:
     FONTS_DIR = os.path.join(BASE_DIR, "fonts")
 
     # 拡張子
-    ALLOWED_UPLOAD_EXTENSIONS = {".xlsx"}
-    ALLOWED_DOWNLOAD_EXTENSIONS = {".pdf", ".xlsx"}
+    ALLOWED_UPLOAD_EXTENSIONS = frozenset({".xlsx"})
+    ALLOWED_DOWNLOAD_EXTENSIONS = frozenset({".pdf", ".xlsx"})
+    # str.endswith にそのまま渡せる小文字のタプル（判定のたびに splitext しない）
+    ALLOWED_UPLOAD_SUFFIXES = tuple(sorted(e.lower() for e in ALLOWED_UPLOAD_EXTENSIONS))
+    ALLOWED_DOWNLOAD_SUFFIXES = tuple(sorted(e.lower() for e in ALLOWED_DOWNLOAD_EXTENSIONS))
 
     # ストレージ（R2 切り替え）
     USE_R2 = os.environ.get("STORAGE_PROVIDER", "").lower() == "r2"
     PRESIGN_EXPIRES = int(os.getenv("PRESIGN_EXPIRES", "3600"))
+    # ファイル一覧（LIST）を使い回す秒数。0 でキャッシュしない
+    LIST_CACHE_TTL = float(os.getenv("LIST_CACHE_TTL", "30"))
 
     # R2 環境変数（USE_R2=True のときに使用）
     S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
@@ -32,11 +38,32 @@ class Config:
     # 生成されたpdfの保管場所　ローカル
     PDF_FOLDER = os.path.join(BASE_DIR, "generated_pdfs")
 
-    # デバッグログ（任意）
+    # ローカル配信をフロントの nginx/Apache に任せる（X-Sendfile 対応のプロキシ配下でのみ有効にする）
+    USE_X_SENDFILE = os.environ.get("USE_X_SENDFILE", "0") == "1"
+
+    # PDF の組版を任せる子プロセス数（ワーカーごと）。0 なら子プロセスを使わずスレッドで組版する。
+    # 複数部の生成が GIL を避けて並列になる代わりに、プロセス数ぶんメモリが増える
+    PDF_PROCESSES = int(os.getenv("PDF_PROCESSES", "0"))
+
+    # 生成PDFのブラウザキャッシュ秒数（ファイル名に uid を含み中身は不変）
+    GENERATED_PDF_MAX_AGE = int(os.getenv("GENERATED_PDF_MAX_AGE", str(365 * 24 * 3600)))
+
+    # ログレベル（本番は INFO/WARNING、詳細を見たいときは DEBUG）
+    LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+    # ロガー設定＋デバッグログ（任意）
     @staticmethod
     def log_env():
-        print("[ENV] STORAGE_PROVIDER:", os.environ.get("STORAGE_PROVIDER"))
-        print("[ENV] S3_BUCKET:", os.environ.get("S3_BUCKET"))
-        print("[ENV] S3_ENDPOINT_URL:", os.environ.get("S3_ENDPOINT_URL"))
-        print("[ENV] S3_ACCESS_KEY_ID:", mask(os.environ.get("S3_ACCESS_KEY_ID")))
-        print("[ENV] S3_SECRET_ACCESS_KEY:", mask(os.environ.get("S3_SECRET_ACCESS_KEY")))
+        logging.basicConfig(
+            level=Config.LOG_LEVEL,
+            format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+        )
+        log = logging.getLogger(__name__)
+        # 環境変数の確認は DEBUG のときだけ（本番の既定 INFO では出さず、mask も呼ばない）
+        if not log.isEnabledFor(logging.DEBUG):
+            return
+        log.debug("[ENV] STORAGE_PROVIDER: %s", os.environ.get("STORAGE_PROVIDER"))
+        log.debug("[ENV] S3_BUCKET: %s", os.environ.get("S3_BUCKET"))
+        log.debug("[ENV] S3_ENDPOINT_URL: %s", os.environ.get("S3_ENDPOINT_URL"))
+        log.debug("[ENV] S3_ACCESS_KEY_ID: %s", mask(os.environ.get("S3_ACCESS_KEY_ID")))
+        log.debug("[ENV] S3_SECRET_ACCESS_KEY: %s", mask(os.environ.get("S3_SECRET_ACCESS_KEY")))
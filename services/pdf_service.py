@@ -1,6 +1,9 @@
 # services/pdf_service.py
 import io
 import os
+import re
+import logging
+import functools
 from typing import Any
 import pandas as pd
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Flowable, Table, TableStyle, Spacer
@@ -10,15 +13,81 @@ from reportlab.lib.pagesizes import A4
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 
+log = logging.getLogger(__name__)
+
+# Paragraph に任せる必要がある文字列（マークアップ / 前後・連続・改行などの空白）
+_NEEDS_PARAGRAPH_RE = re.compile(r"[<>&]|^\s|\s$|\s\s|[^\S ]")
+
+@functools.lru_cache(maxsize=8192)
+def _string_width(text: str, font_name: str, font_size: float) -> float:
+    # 同じ文字列を計測と問題/解答 PDF の描画で何度も測るので、結果を覚えておく
+    # （フォントは内部名ごとにプロセスで1回しか登録しないので、幅が変わることはない）
+    return pdfmetrics.stringWidth(text, font_name, font_size)
+
+def fits_one_line(text: str, style, width: float) -> bool:
+    """マークアップを含まず、width に1行で収まるプレーンな文字列か。"""
+    return (
+        bool(text)
+        and not _NEEDS_PARAGRAPH_RE.search(text)
+        and _string_width(text, style.fontName, style.fontSize) <= width
+    )
+
+def draw_text(canv, text: str, style, x: float, width: float, box_h: float, para=None):
+    """
+    box_h の高さの枠に text を縦中央で描く。
+    1行に収まるプレーンテキストは Paragraph を作らず drawString で直接描く
+    （位置は Paragraph の1行目と同じ: 上端から fontSize 下がベースライン）。
+    para に同じ text・style・width で wrap 済みの Paragraph を渡すと、作り直さずそのまま描く。
+    """
+    if para is not None:
+        para.drawOn(canv, x, max(0, (box_h - para.height) / 2))
+        return
+    if fits_one_line(text, style, width):
+        y = max(0, (box_h - style.leading) / 2)
+        canv.setFillColor(style.textColor)
+        canv.setFont(style.fontName, style.fontSize)
+        canv.drawString(x, y + style.leading - style.fontSize, text)
+        return
+    p = Paragraph(text, style)
+    w, h = p.wrap(width, box_h)
+    p.drawOn(canv, x, max(0, (box_h - h) / 2))
+
+def draw_box(canv, width: float, height: float, radius: float):
+    """
+    (0, 0) を左下に青い角丸枠を描く。
+    同じ寸法の枠は PDF ごとに1回だけ Form XObject として書き出し、以降はそれを参照する
+    （roundRect の曲線を行ごとに数値整形して出力しない）。
+    """
+    name = f"box_{width:.2f}x{height:.2f}r{radius}"
+    if not canv.hasForm(name):
+        canv.beginForm(name, -1, -1, width + 1, height + 1)
+        canv.setStrokeColor(colors.blue)
+        canv.setLineWidth(0.5)
+        canv.roundRect(0, 0, width, height, radius, stroke=1, fill=0)
+        canv.endForm()
+    canv.doForm(name)
+
 # === 段落の必要高さを計測するユーティリティ ===
+def measure_para(text: str, style, box_width: float, padding: int = 8, min_h: int = 40):
+    """
+    (必要高さ, wrap 済みの Paragraph) を返す。1行に収まるプレーンテキストは Paragraph を作らず None。
+    Paragraph.wrap の結果は幅だけで決まるので、同じ幅で描くときは draw_text(para=...) に渡して使い回せる。
+    """
+    if fits_one_line(text, style, box_width - 2*padding):
+        h, p = style.leading, None  # 1行ぶん（Paragraph.wrap と同じ値）
+    else:
+        p = Paragraph(text or "", style)
+        _, h = p.wrap(box_width - 2*padding, 10**6)
+    return max(min_h, int(h + 2*padding)), p
+
 def measure_para_height(text: str, style, box_width: float, padding: int = 8, min_h: int = 40) -> int:
-    from reportlab.platypus import Paragraph
-    p = Paragraph(text or "", style)
-    _, h = p.wrap(box_width - 2*padding, 10**6)
-    return max(min_h, int(h + 2*padding))
+    return measure_para(text, style, box_width, padding, min_h)[0]
 
 def register_fonts(fonts_dir: str):
     font_name = "Helvetica"
+    # 同じプロセスで登録済みなら、フォントの探索も TTF の読み込みもしない
+    if "NotoSansJP" in pdfmetrics.getRegisteredFontNames():
+        return "NotoSansJP"
     candidates = [
         "NotoSansJP-Regular.ttf",
         "NotoSansCJKjp-Regular.otf",
@@ -35,12 +104,12 @@ def register_fonts(fonts_dir: str):
         try:
             pdfmetrics.registerFont(TTFont("NotoSansJP", selected))
             font_name = "NotoSansJP"
-            print(f"[Font] OK: {selected} を使用（内部名: {font_name}）")
+            log.info("[Font] OK: %s を使用（内部名: %s）", selected, font_name)
         except Exception as e:
-            print(f"[Font] 登録失敗: {selected}: {e}")
-            print("[Font] Helvetica にフォールバックします。")
+            log.warning("[Font] 登録失敗: %s: %s", selected, e)
+            log.warning("[Font] Helvetica にフォールバックします。")
     else:
-        print("[Font] 候補フォントなし。Helvetica を使用。")
+        log.warning("[Font] 候補フォントなし。Helvetica を使用。")
     return font_name
 
 def build_styles(font_name: str):
@@ -71,24 +140,20 @@ class NumberBox(Flowable):
         self.font_name = font_name
     def wrap(self, aw, ah): return self.width, self.height
     def draw(self):
-        self.canv.setStrokeColor(colors.blue)
-        self.canv.setLineWidth(0.5)
-        self.canv.roundRect(0, 0, self.width, self.height, self.radius, stroke=1, fill=0)
+        draw_box(self.canv, self.width, self.height, self.radius)
         self.canv.setFillColor(colors.black)
         self.canv.setFont(self.font_name, 10)
         self.canv.drawCentredString(self.width/2, self.height/2 - 4, str(self.number))
 
 class RoundedBox(Flowable):
-    def __init__(self, text, styles, width=100, height=40, radius=6, padding=4):
+    def __init__(self, text, styles, width=100, height=40, radius=6, padding=4, para=None):
         super().__init__()
         self.text=text; self.styles=styles; self.width=width; self.height=height; self.radius=radius; self.padding=padding
+        self.para=para  # 計測時に width-2*padding で wrap 済みの Paragraph（あれば）
     def wrap(self, aw, ah): return self.width, self.height
     def draw(self):
-        self.canv.setStrokeColor(colors.blue); self.canv.setLineWidth(0.5)
-        self.canv.roundRect(0,0,self.width,self.height,self.radius, stroke=1, fill=0)
-        p = Paragraph(self.text, self.styles["Q"])
-        w,h = p.wrap(self.width-2*self.padding, self.height-2*self.padding)
-        p.drawOn(self.canv, self.padding, max(0,(self.height-h)/2))
+        draw_box(self.canv, self.width, self.height, self.radius)
+        draw_text(self.canv, self.text, self.styles["Q"], self.padding, self.width-2*self.padding, self.height, para=self.para)
 
 class AnswerBox(Flowable):
     def __init__(self, styles, width=100, height=40, radius=6, answer=None):
@@ -96,12 +161,9 @@ class AnswerBox(Flowable):
         self.styles=styles; self.width=width; self.height=height; self.radius=radius; self.answer=answer
     def wrap(self, aw, ah): return self.width, self.height
     def draw(self):
-        self.canv.setStrokeColor(colors.blue); self.canv.setLineWidth(0.5)
-        self.canv.roundRect(0,0,self.width,self.height,self.radius, stroke=1, fill=0)
+        draw_box(self.canv, self.width, self.height, self.radius)
         if self.answer:
-            p = Paragraph(self.answer, self.styles["A"])
-            w,h = p.wrap(self.width-8, self.height-8)
-            p.drawOn(self.canv, 4, max(0,(self.height-h)/2))
+            draw_text(self.canv, self.answer, self.styles["A"], 4, self.width-8, self.height)
 
 # === セル値 → 表示文字列 変換（単一責務ヘルパー） ===
 def cell_to_text(v: Any, *, strip: bool = True, uppercase_bool: bool = False) -> str:
@@ -118,99 +180,175 @@ def cell_to_text(v: Any, *, strip: bool = True, uppercase_bool: bool = False) ->
     s = str(v)
     return s.strip() if strip else s
 
-def build_pdf(
-    df: pd.DataFrame,
-    styles,
-    with_answers: bool = False,
-    *,
-    question_col: str = "word",     # 英和=word / 和英=meaning
-    answer_col: str = "meaning",    # 英和=meaning / 和英=word
-    title=None,
-):
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, leftMargin=20, rightMargin=20, topMargin=20, bottomMargin=20)
-    story = []
+# === レイアウト（A4・余白 20pt・左右2セット: 番号/問題/解答） ===
+# どれも定数だけで決まるので、PDF ごとに計算し直さない
+_MARGIN = 20
+_GAP = 12
+_NUM_WIDTH = 40
+_PADDING = 8  # 計測/描画で整合を取るため固定
+_BASE_ROW_H = 40  # 最低行高
+_REMAINING_WIDTH = A4[0] - _MARGIN*2 - _NUM_WIDTH*2 - _GAP*5
+_Q_WIDTH = _REMAINING_WIDTH * 0.5 / 2
+_A_WIDTH = _REMAINING_WIDTH * 0.5 / 2
+_COL_WIDTHS = (_NUM_WIDTH, _GAP, _Q_WIDTH, _GAP, _A_WIDTH,
+               _GAP, _NUM_WIDTH, _GAP, _Q_WIDTH, _GAP, _A_WIDTH)
+_TABLE_CHUNK_ROWS = 250  # 1つの Table に入れる行数の上限
+_TABLE_STYLE = TableStyle([
+    ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+    ("LEFTPADDING", (0, 0), (-1, -1), 0),
+    ("RIGHTPADDING", (0, 0), (-1, -1), 0),
+    ("TOPPADDING", (0, 0), (-1, -1), 0),
+    ("BOTTOMPADDING", (0, 0), (-1, -1), 0),
+])
 
-    # タイトル（任意）
-    if title:
-        story.append(Paragraph(title, styles.get("TitleJP", styles["Q"])))
-        story.append(Spacer(1, 6))  # 少し余白
-
-    PAGE_WIDTH, PAGE_HEIGHT = A4
-    usable_width = PAGE_WIDTH - doc.leftMargin - doc.rightMargin
-    gap = 12
-    num_width = 40
-    base_row_h = 40  # 最低行高
+def _new_doc(buffer):
+    return SimpleDocTemplate(buffer, pagesize=A4, leftMargin=_MARGIN, rightMargin=_MARGIN, topMargin=_MARGIN, bottomMargin=_MARGIN)
 
-    # 左右2セット（番号/問題/解答）
-    remaining_width = usable_width - num_width*2 - gap*5
-    q_width = remaining_width * 0.5 / 2
-    a_width = remaining_width * 0.5 / 2
-
-    colWidths = [num_width, gap, q_width, gap, a_width,
-                 gap, num_width, gap, q_width, gap, a_width]
+def _measure_rows(df, styles, *, question_col, answer_col, with_answers):
+    """
+    各行の (番号, 問題文, 解答文, 問題の必要高さ, 解答の必要高さ, 問題の Paragraph) を求める。
+    with_answers=False なら解答は読まず、解答の高さは最低行高のまま。
+    問題の Paragraph は描画と同じ幅で wrap 済み（1行に収まるときは None）で、問題/解答 PDF の両方で使い回す。
+    """
+    # iterrows で行ごとに Series を作らず、使う列だけ Python のリストにして回す
+    def column(name, missing):
+        return df[name].tolist() if name in df.columns else [missing] * len(df)
 
-    font_for_boxes = styles["Q"].fontName
-    padding = 8  # 計測/描画で整合を取るため固定
+    numbers = column("number", "")
+    questions = column(question_col, None)
+    answers = column(answer_col, None) if with_answers else [None] * len(df)
 
-    data = []
-    row = []
-    pair = []  # 左右2問をまとめて高さ決定
+    # StyleSheet1 の [] は別名表を先に引いて KeyError を経由するので、ループの外で1回だけ引く
+    style_q, style_a = styles["Q"], styles["A"]
 
-    for i, r in df.iterrows():
+    rows = []
+    for number, question, answer in zip(numbers, questions, answers):
         # 値の準備
         try:
-            disp_no = int(r.get("number", ""))
+            disp_no = int(number)
         except Exception:
-            disp_no = r.get("number", "")
+            disp_no = number
 
         # 出題/解答（ブール/NaNを安全に扱う）
-        q_text = cell_to_text(r.get(question_col, None))
-        ans_text = cell_to_text(r.get(answer_col, None)) if with_answers else ""
+        q_text = cell_to_text(question)
+        ans_text = cell_to_text(answer) if with_answers else ""
 
         # 高さ計測
-        h_q = measure_para_height(q_text, styles["Q"], q_width, padding=padding, min_h=base_row_h)
-        h_a = measure_para_height(ans_text, styles["A"], a_width, padding=padding, min_h=base_row_h) if with_answers else base_row_h
-        need_h = max(base_row_h, h_q, h_a)
+        h_q, q_para = measure_para(q_text, style_q, _Q_WIDTH, padding=_PADDING, min_h=_BASE_ROW_H)
+        h_a = measure_para_height(ans_text, style_a, _A_WIDTH, padding=_PADDING, min_h=_BASE_ROW_H) if with_answers else _BASE_ROW_H
+        rows.append((disp_no, q_text, ans_text, h_q, h_a, q_para))
+    return rows
 
-        pair.append((disp_no, q_text, ans_text, need_h))
+def _render_pdf(buffer, doc, rows, styles, *, with_answers, title):
+    """計測済みの行から PDF を組み立てて buffer に書き出す。"""
+    font_for_boxes = styles["Q"].fontName
+    story = []
 
-        # 2件そろうか最終行で1段作成
-        if len(pair) == 2 or i == len(df) - 1:
-            left = pair[0]
-            right = pair[1] if len(pair) == 2 else None
-            row_h = max(left[3], right[3] if right else base_row_h)
+    # タイトル（任意）
+    if title:
+        story.append(Paragraph(title, styles.get("TitleJP", styles["Q"])))
+        story.append(Spacer(1, 6))  # 少し余白
+
+    # 各セルの描画で引くスタイルは、解決済みの普通の dict で渡す
+    box_styles = {"Q": styles["Q"], "A": styles["A"]}
+
+    def need_h(row):
+        # 問題用は問題文だけ、解答用は解答文も含めて行高を決める
+        return max(_BASE_ROW_H, row[3], row[4]) if with_answers else max(_BASE_ROW_H, row[3])
+
+    data = []
+    # 左右2問をまとめて高さ決定
+    for k in range(0, len(rows), 2):
+        left = rows[k]
+        right = rows[k + 1] if k + 1 < len(rows) else None
+        row_h = max(need_h(left), need_h(right) if right else _BASE_ROW_H)
 
-            # 左側
+        # 左側
+        row = [
+            NumberBox(left[0], _NUM_WIDTH, row_h, font_name=font_for_boxes), "",
+            RoundedBox(left[1], box_styles, _Q_WIDTH, row_h, padding=_PADDING, para=left[5]), "",
+            AnswerBox(box_styles, _A_WIDTH, row_h, answer=left[2] if with_answers else None)
+        ]
+
+        # 右側（無ければ空埋め）
+        if right:
             row.extend([
-                NumberBox(left[0], num_width, row_h, font_name=font_for_boxes), "",
-                RoundedBox(left[1], styles, q_width, row_h, padding=padding), "",
-                AnswerBox(styles, a_width, row_h, answer=left[2] if with_answers else None)
+                "", NumberBox(right[0], _NUM_WIDTH, row_h, font_name=font_for_boxes), "",
+                RoundedBox(right[1], box_styles, _Q_WIDTH, row_h, padding=_PADDING, para=right[5]), "",
+                AnswerBox(box_styles, _A_WIDTH, row_h, answer=right[2] if with_answers else None)
             ])
+        else:
+            # 右側の6列（間隔を含む）を空で埋め、どの行も _COL_WIDTHS と同じ列数にする。
+            # 最後の Table がこの1行だけになっても列数が変わらず、中央寄せの位置がずれない
+            row.extend([""] * 6)
+
+        data.append(row)
 
-            # 右側（無ければ空埋め）
-            if right:
-                row.extend([
-                    "", NumberBox(right[0], num_width, row_h, font_name=font_for_boxes), "",
-                    RoundedBox(right[1], styles, q_width, row_h, padding=padding), "",
-                    AnswerBox(styles, a_width, row_h, answer=right[2] if with_answers else None)
-                ])
-            else:
-                row.extend(["", "", "", "", ""])
-
-            data.append(row)
-            row = []
-            pair = []
-
-    table = Table(data, colWidths=colWidths, hAlign="CENTER")
-    table.setStyle(TableStyle([
-        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
-        ("LEFTPADDING", (0, 0), (-1, -1), 0),
-        ("RIGHTPADDING", (0, 0), (-1, -1), 0),
-        ("TOPPADDING", (0, 0), (-1, -1), 0),
-        ("BOTTOMPADDING", (0, 0), (-1, -1), 0),
-    ]))
-    story.append(table)
+    # 1つの巨大な Table にすると、改ページのたびに残り全行を split し直すので、
+    # _TABLE_CHUNK_ROWS 行ずつの Table に分けて並べる（行の境目で切るので見た目は同じ）
+    for start in range(0, len(data), _TABLE_CHUNK_ROWS):
+        # colWidths は list で渡す（tuple だと列数の合わない行を Table が補ってくれない。
+        # Table は受け取った list を書き換えることがあるので、定数はコピーして渡す）
+        table = Table(data[start:start + _TABLE_CHUNK_ROWS], colWidths=list(_COL_WIDTHS), hAlign="CENTER")
+        table.setStyle(_TABLE_STYLE)
+        story.append(table)
     doc.build(story)
     buffer.seek(0)
     return buffer
+
+def build_pdf(
+    df: pd.DataFrame,
+    styles,
+    with_answers: bool = False,
+    *,
+    question_col: str = "word",     # 英和=word / 和英=meaning
+    answer_col: str = "meaning",    # 英和=meaning / 和英=word
+    title=None,
+    out=None,
+):
+    """
+    PDF を生成して返す。out（書き込み可能なファイルライク）を渡すとそこへ直接書き出し、
+    渡さなければ BytesIO に書いて返す。
+    """
+    buffer = io.BytesIO() if out is None else out
+    rows = _measure_rows(df, styles, question_col=question_col, answer_col=answer_col, with_answers=with_answers)
+    return _render_pdf(buffer, _new_doc(buffer), rows, styles, with_answers=with_answers, title=title)
+
+# プロセスごとのスタイル（build_pdf_pair_bytes 用）
+_WORKER_STYLES = {}
+
+def build_pdf_pair_bytes(df: pd.DataFrame, fonts_dir: str, **kwargs):
+    """
+    build_pdf_pair を子プロセスで実行するための入口。(問題, 解答) を bytes で返す。
+    スタイル（フォント）は pickle で渡さず、プロセスごとに最初の1回だけ作る。
+    """
+    styles = _WORKER_STYLES.get(fonts_dir)
+    if styles is None:
+        styles = _WORKER_STYLES[fonts_dir] = build_styles(register_fonts(fonts_dir))
+    q_buffer, a_buffer = build_pdf_pair(df, styles, **kwargs)
+    return q_buffer.getvalue(), a_buffer.getvalue()
+
+def build_pdf_pair(
+    df: pd.DataFrame,
+    styles,
+    *,
+    question_col: str = "word",
+    answer_col: str = "meaning",
+    title_q=None,
+    title_a=None,
+    q_out=None,
+    a_out=None,
+):
+    """
+    同じ出題の問題 PDF と解答 PDF を (問題, 解答) の BytesIO で返す。
+    q_out / a_out を渡すと、BytesIO の代わりにそのファイルライクへ直接書き出す。
+    行の取り出しと段落の高さ計測は1回だけ行い、2つの PDF で共有する。
+    レイアウトは build_pdf を2回呼んだ場合と同じ。
+    """
+    q_buffer = io.BytesIO() if q_out is None else q_out
+    a_buffer = io.BytesIO() if a_out is None else a_out
+    rows = _measure_rows(df, styles, question_col=question_col, answer_col=answer_col, with_answers=True)
+    return (
+        _render_pdf(q_buffer, _new_doc(q_buffer), rows, styles, with_answers=False, title=title_q),
+        _render_pdf(a_buffer, _new_doc(a_buffer), rows, styles, with_answers=True, title=title_a),
+    )
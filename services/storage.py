@@ -1,19 +1,31 @@
 # services/storage.py
 import os
+import shutil
+import secrets
 from typing import List, Optional
 
+# ファイルライクをストリームでコピーするときのバッファサイズ
+COPY_BUFSIZE = 1 << 20
+
+# 一覧に含める拡張子（小文字化した名前に str.endswith で当てる）
+XLSX_SUFFIX = ".xlsx"
+
+
 class Storage:
     """抽象インターフェース"""
     def upload(self, file_or_bytes, key, content_type="application/octet-stream"): ...
-    def presign_get(self, key, expires: int) -> Optional[str]: ...
+    def presign_get(self, key, expires: int, cache_control: Optional[str] = None) -> Optional[str]: ...
+    def presign_put(self, key, content_type: str, content_length: int, expires: int) -> Optional[str]: ...
     def list_xlsx(self, prefix: str = "uploads/") -> List[str]: ...
     def open_xlsx_as_bytes(self, key: str) -> bytes: ...
+    def head(self, key: str) -> str: ...
 
 
 # --- R2 実装 ---
 class R2Storage(Storage):
     def __init__(self, bucket, endpoint_url, access_key, secret_key, presign_expires):
         import boto3
+        from boto3.s3.transfer import TransferConfig
         from botocore.config import Config
         self.bucket = bucket
         self.presign_expires = presign_expires
@@ -23,41 +35,65 @@ class R2Storage(Storage):
             aws_access_key_id=access_key,
             aws_secret_access_key=secret_key,
             region_name="auto",
-            config=Config(signature_version="s3v4", s3={"addressing_style": "path"}),
+            # PDF プール（4本）× upload_fileobj の並列パートが同時に使うので、
+            # 既定の 10 本では足りず接続を捨てて張り直すことになる
+            config=Config(
+                signature_version="s3v4",
+                s3={"addressing_style": "path"},
+                max_pool_connections=32,
+                retries={"mode": "standard", "max_attempts": 3},
+                tcp_keepalive=True,
+            ),
         )
+        # 8MB を超えるものはマルチパート（パート並列）で送る
+        self.transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024, use_threads=True)
 
     def upload(self, file_or_bytes, key, content_type="application/octet-stream"):
-        body = file_or_bytes.read() if hasattr(file_or_bytes, "read") else file_or_bytes
-        self.s3.put_object(Bucket=self.bucket, Key=key, Body=body, ContentType=content_type)
-
-    def presign_get(self, key, expires=None):
+        if hasattr(file_or_bytes, "read"):
+            # ファイルライクは丸ごと read() せず、boto3 にチャンク単位で送らせる
+            self.s3.upload_fileobj(
+                file_or_bytes,
+                self.bucket,
+                key,
+                ExtraArgs={"ContentType": content_type},
+                Config=self.transfer_config,
+            )
+        else:
+            self.s3.put_object(Bucket=self.bucket, Key=key, Body=file_or_bytes, ContentType=content_type)
+
+    def presign_get(self, key, expires=None, cache_control=None):
+        params = {"Bucket": self.bucket, "Key": key}
+        if cache_control:
+            # 応答の Cache-Control を上書きさせる（署名に含まれる）
+            params["ResponseCacheControl"] = cache_control
         return self.s3.generate_presigned_url(
             "get_object",
-            Params={"Bucket": self.bucket, "Key": key},
+            Params=params,
+            ExpiresIn=expires or self.presign_expires,
+        )
+
+    def presign_put(self, key, content_type, content_length, expires=None):
+        # ブラウザから直接 PUT させる署名 URL。Content-Type と Content-Length も署名に含めるので、
+        # PUT 時に一致しなければ拒否される（申告したサイズ以外は送れない）
+        return self.s3.generate_presigned_url(
+            "put_object",
+            Params={"Bucket": self.bucket, "Key": key, "ContentType": content_type, "ContentLength": content_length},
             ExpiresIn=expires or self.presign_expires,
         )
 
     def list_xlsx(self, prefix="uploads/"):
         """
         uploads/ 以下の .xlsx を **フルキーのまま** 返す。
-        階層を潰さない。大量ファイルに備えて継続トークン対応。
+        階層を潰さない。1000 件を超える分は paginator が継続トークンで辿る。
+        （拡張子の大文字小文字を区別しないため、絞り込みは JMESPath ではなくここで行う）
         """
         out = []
-        continuation = None
-        while True:
-            kwargs = {"Bucket": self.bucket, "Prefix": prefix}
-            if continuation:
-                kwargs["ContinuationToken"] = continuation
-            resp = self.s3.list_objects_v2(**kwargs)
-            for obj in resp.get("Contents", []):
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, PaginationConfig={"PageSize": 1000}):
+            for obj in page.get("Contents", []):
                 key = obj["Key"]
-                _, ext = os.path.splitext(key)
-                if ext.lower() == ".xlsx":
+                if key.lower().endswith(XLSX_SUFFIX):
                     out.append((key, obj["LastModified"]))
-            if resp.get("IsTruncated"):
-                continuation = resp.get("NextContinuationToken")
-            else:
-                break
         out.sort(key=lambda x: x[1], reverse=True)
         # ✅ ここで basename にしない
         return [k for k, _ in out]
@@ -67,6 +103,10 @@ class R2Storage(Storage):
         obj = self.s3.get_object(Bucket=self.bucket, Key=key)
         return obj["Body"].read()
 
+    def head(self, key: str) -> str:
+        """オブジェクトの版を表す文字列（ETag）。中身が変われば変わる。"""
+        return self.s3.head_object(Bucket=self.bucket, Key=key)["ETag"]
+
 
 # --- ローカル実装 ---
 class LocalStorage(Storage):
@@ -93,32 +133,44 @@ class LocalStorage(Storage):
         """
         rel = self._strip_prefix(key)  # '中1/Excelデータ/lesson1.xlsx'
         dst = os.path.join(self.upload_dir, rel)
-        os.makedirs(os.path.dirname(dst), exist_ok=True)
-        data = file_or_bytes.read() if hasattr(file_or_bytes, "read") else file_or_bytes
-        with open(dst, "wb") as f:
-            f.write(data)
-
-    def presign_get(self, key, expires=None):
+        dst_dir = os.path.dirname(dst)
+        os.makedirs(dst_dir, exist_ok=True)
+        # 同じディレクトリの一時ファイルに書き切ってから置き換える。
+        # 途中で切断やディスクエラーが起きても、既存のファイルは壊さない
+        # （tempfile は 0600 で作るので使わない。X-Sendfile で配るプロキシからも読める権限にする）
+        tmp = os.path.join(dst_dir, f".upload-{secrets.token_hex(8)}.tmp")
+        try:
+            with open(tmp, "xb") as f:
+                if hasattr(file_or_bytes, "read"):
+                    # 全体をメモリに載せず 1MiB ずつ書き出す
+                    shutil.copyfileobj(file_or_bytes, f, COPY_BUFSIZE)
+                else:
+                    f.write(file_or_bytes)
+            os.replace(tmp, dst)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def presign_get(self, key, expires=None, cache_control=None):
         # ローカルは署名URLなし → 画面側で /download_file に誘導
         return None
 
+    def presign_put(self, key, content_type, content_length, expires=None):
+        # ローカルは直接アップロード不可 → 従来どおり /upload にフォーム送信
+        return None
+
     def list_xlsx(self, prefix="uploads/"):
         """
         uploads/ 配下を再帰で探索して、R2 と同じく **'uploads/...'** で返す。
         更新日時降順（mtime）にソート。
+        os.walk ではなく _walk_xlsx（os.scandir の再帰）で走査し、mtime は DirEntry から取る。
         """
-        out: list[str] = []
-        base = self.upload_dir  # 実体ディレクトリ（uploads の中身）
-        for root, _, files in os.walk(base):
-            for name in files:
-                if os.path.splitext(name)[1].lower() != ".xlsx":
-                    continue
-                full = os.path.join(root, name)
-                rel = os.path.relpath(full, base).replace("\\", "/")  # '中1/Excelデータ/lesson1.xlsx'
-                out.append(rel)
-        out.sort(key=lambda rel: os.path.getmtime(os.path.join(base, rel)), reverse=True)
+        # 実体ディレクトリ（uploads の中身）
+        out = list(_walk_xlsx(self.upload_dir))
+        out.sort(key=lambda x: x[1], reverse=True)
         # ✅ 返り値は 'uploads/...' に揃える
-        return [f"uploads/{rel}" for rel in out]
+        return [f"uploads/{rel}" for rel, _ in out]
 
     def open_xlsx_as_bytes(self, key: str) -> bytes:
         """key は 'uploads/...' または相対パスを許容"""
@@ -127,6 +179,29 @@ class LocalStorage(Storage):
         with open(path, "rb") as f:
             return f.read()
 
+    def head(self, key: str) -> str:
+        """ファイルの版を表す文字列（mtime とサイズ）。上書きされれば変わる。"""
+        st = os.stat(os.path.join(self.upload_dir, self._strip_prefix(key)))
+        return f"{st.st_mtime_ns}-{st.st_size}"
+
+
+def _walk_xlsx(root: str, rel: str = ""):
+    """
+    root 配下の .xlsx を (相対パス, mtime) で yield する。
+    相対パスは rel + e.name を連結して作るので relpath / 区切り置換は不要。
+    例: '中1/Excelデータ/lesson1.xlsx'
+    """
+    try:
+        it = os.scandir(root)
+    except OSError:
+        return
+    with it:
+        for e in it:
+            if e.is_dir(follow_symlinks=False):
+                yield from _walk_xlsx(e.path, rel + e.name + "/")
+            elif e.name.lower().endswith(XLSX_SUFFIX) and e.is_file():
+                yield rel + e.name, e.stat().st_mtime
+
 
 # --- ファクトリ ---
 def get_storage(cfg) -> Storage:
@@ -2,17 +2,22 @@
 import os
 import re
 
+# ファイル名に使えない記号（連続は1つの _ にまとめる）
+_UNSAFE_RE = re.compile(r'[\\/:*?"<>|]+')
+
 def safe_filename(name: str) -> str:
     name = os.path.basename(name)           # パストラバーサル対策
     name = name.replace("\x00", "")         # ヌルバイト除去
-    name = re.sub(r'[\\/:*?"<>|]+', "_", name)  # 危険記号を _
+    name = _UNSAFE_RE.sub("_", name)        # 危険記号を _
     return name.strip()
 
 def list_xlsx_local(upload_dir: str):
-    files = []
-    for f in os.listdir(upload_dir):
-        full = os.path.join(upload_dir, f)
-        if os.path.isfile(full) and os.path.splitext(f)[1].lower() == ".xlsx":
-            files.append(f)
-    files.sort(key=lambda x: os.path.getctime(os.path.join(upload_dir, x)), reverse=True)
-    return files
+    # scandir の DirEntry を使い、stat はファイルごとに1回だけ
+    with os.scandir(upload_dir) as it:
+        entries = [
+            (e.name, e.stat().st_ctime)
+            for e in it
+            if e.name.lower().endswith(".xlsx") and e.is_file()
+        ]
+    entries.sort(key=lambda x: x[1], reverse=True)
+    return [name for name, _ in entries]